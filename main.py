@@ -7,15 +7,16 @@ import logging
 import logging.config
 import os
 import sys
-from mptk import general_functions, hash_headers, parse_singlem, use_amplicon, use_functional_subset, \
-  subset_sequences, parse_taxonomy, parse_functions_cog, parse_functions_uniprot
+
+_CONFIGURED = None
 
 
 def configure_logger(name, log_file, level="DEBUG"):
     """
     Creates the logger for the program.
 
-    The function creates the basic configuration for the logging of all events.
+    The function creates the basic configuration for the logging of all events. The configuration is only applied
+    once; repeated calls with the same log file and level return the logger without reconfiguring the handlers.
 
     Parameter
     ---------
@@ -28,6 +29,11 @@ def configure_logger(name, log_file, level="DEBUG"):
       the configured logger
 
     """
+    global _CONFIGURED
+
+    if _CONFIGURED == (log_file, level):
+        return logging.getLogger(name)
+
     logging.config.dictConfig({
         'version': 1,
         'formatters': {
@@ -58,10 +64,116 @@ def configure_logger(name, log_file, level="DEBUG"):
         },
         'disable_existing_loggers': False
     })
+    _CONFIGURED = (log_file, level)
 
     return logging.getLogger(name)
 
 
+def _do_prepare_uniprot_files(args, logger):
+    logger.info("parsing UniProt file")
+    from mptk import general_functions
+    general_functions.parse_uniprot_file(uniprot_file=args.uniprot_file, uniprot_table=args.uniprot_table,
+                                         go_annotation=args.go_annotation)
+
+
+def _do_parse_singlem(args, logger):
+    logger.info("parsing OTU table")
+    from mptk import general_functions, parse_singlem
+    abspath_names_dmp = general_functions.get_names_dmp(names_dmp=args.names_dmp)
+    tax_dict = general_functions.create_tax_dict(abspath_names_dmp=abspath_names_dmp)
+    data_frame = parse_singlem.read_table(input_file=args.otu_table)
+    tax_list = parse_singlem.calculate_abundant_otus(df=data_frame, level=args.level, cutoff=args.cutoff)
+    validated_tax_list = parse_singlem.validate_taxon_names(taxon_names=tax_list, ncbi_tax_dict=tax_dict)
+    parse_singlem.write_taxon_list(validated_taxon_names=validated_tax_list,
+                                   taxon_file=args.taxon_file)
+
+
+def _do_amplicon(args, logger):
+    logger.info("started amplicon analysis")
+    from mptk import general_functions, use_amplicon
+    abspath_names_dmp = general_functions.get_names_dmp(names_dmp=args.names_dmp)
+    tax_dict = general_functions.create_tax_dict(abspath_names_dmp=abspath_names_dmp)
+    taxids = use_amplicon.get_taxid(input_file=args.genus_list)
+    use_amplicon.get_protein_sequences(tax_list=taxids, output_file=args.proteome_file, ncbi_tax_dict=tax_dict,
+                                       reviewed=args.reviewed, add_taxonomy=args.taxonomy, processes=args.processes)
+
+
+def _do_function_subset(args, logger):
+    logger.info("creating functional subsets")
+    from mptk import use_amplicon, use_functional_subset
+    query_command = use_functional_subset.search_lists_to_query_url(args.toml_file)
+    use_amplicon.get_protein_sequences(tax_list=False, query=query_command, output_file=args.proteome_file, reviewed=args.reviewed, add_taxonomy=args.taxonomy)
+
+
+def _do_hashing(args, logger):
+    logger.info("hashing protein headers")
+    from mptk import hash_headers
+    hash_headers.write_hashed_protein_header_fasta_file(input_file=args.proteome_file, output_file=args.hashed_file,
+                                                        tsv_file=args.tsv_file, hash_type=args.hash_type)
+
+
+def _do_subset_sequences(args, logger):
+    logger.info("subsetting sequences")
+    from mptk import subset_sequences
+    df = subset_sequences.parse_proteinpilot_file(excel_file=args.excel_file)
+    subset_sequences.subset_sequence_file(df=df, sequence_file=args.database_file,
+                                          sequence_file_subset=args.database_subset)
+
+
+def _do_protein_groups(args, logger):
+    logger.info("use protein groups")
+    from mptk import general_functions
+    general_functions.map_protein_groups(diamond_file=args.diamond_file, excel_file=args.excel_file,
+                                         diamond_file_protein_groups=args.diamond_protein_groups)
+
+
+def _do_taxonomy(args, logger):
+    logger.info("parsing megan taxonomy file")
+    from mptk import parse_taxonomy
+    parse_taxonomy.parse_table(input_file=args.megan_results, output_file=args.taxonomy_table)
+
+
+def _do_functions_cog(args, logger):
+    logger.info("running COG analysis")
+    from mptk import general_functions, parse_functions_cog
+    cog_df = general_functions.parse_diamond_output(diamond_file=args.diamond_file)
+    cog_df_merged = parse_functions_cog.join_tables(df=cog_df, cog_table=args.cog_table, cog_names=args.cog_names)
+    cog_df_grouped = parse_functions_cog.group_table(df=cog_df_merged, cog_functions=args.cog_functions)
+    parse_functions_cog.export_table(df=cog_df_grouped, output_file=args.export_table)
+
+
+def _do_functions_uniprot(args, logger):
+    logger.info("running Uniprot analysis")
+    from mptk import general_functions, parse_functions_uniprot
+    uniprot_df = general_functions.parse_diamond_output(diamond_file=args.diamond_file)
+    uniprot_df_merged = parse_functions_uniprot.join_tables(uniprot_df, uniprot_table=args.uniprot_table,
+                                                            go_annotation=args.go_annotation)
+    uniprot_df_grouped = parse_functions_uniprot.group_table(uniprot_df_merged)
+    parse_functions_uniprot.export_table(df=uniprot_df_grouped, output_file=args.export_table)
+
+
+def _do_export_tables(args, logger):
+    logger.info("exporting tables")
+    from mptk import general_functions
+    general_functions.export_result_tables(excel_file=args.excel_file, annotated_table=args.annotated_table,
+                                           output_table=args.output_table)
+
+
+DISPATCH = {
+    "prepare_uniprot_files": _do_prepare_uniprot_files,
+    "parse_singlem": _do_parse_singlem,
+    "amplicon": _do_amplicon,
+    "function_subset": _do_function_subset,
+    "hashing": _do_hashing,
+    "subset_sequences": _do_subset_sequences,
+    "protein_groups": _do_protein_groups,
+    "taxonomy": _do_taxonomy,
+    "functions_cog": _do_functions_cog,
+    "functions_uniprot": _do_functions_uniprot,
+    "export_tables": _do_export_tables,
+}
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -115,6 +227,8 @@ def main():
                                     help="use unreviewed TrEMBL hits (default) or only reviewed SwissProt")
     subparser_amplicon.add_argument("-t", "--taxonomy", action="store_true", dest="taxonomy", required=False,
                                     help="add taxonomic lineage to fasta header")
+    subparser_amplicon.add_argument("-j", "--processes", action="store", dest="processes", type=int, required=False,
+                                    default=1, help="number of processes used to add the taxonomy (default: 1)")
 
     subparser_functionsubset.add_argument("-t", "--toml_file", action="store", dest="toml_file", required=True,
                                           help="toml file with taxonomy, gene and protein names")
@@ -129,8 +243,8 @@ def main():
                                    help="proteome output file with hashed headers")
     subparser_hashing.add_argument("-t", "--tsv_file", action="store", dest="tsv_file", required=True,
                                    help="proteome output file with hashed headers")
-    subparser_hashing.add_argument("-x", "--hash_type", choices=["md5", "sha1"], dest="hash_type", default="md5",
-                                   help="hash algorithm to use")
+    subparser_hashing.add_argument("-x", "--hash_type", choices=["md5", "sha1", "sha256", "blake2b"], dest="hash_type",
+                                   default="blake2b", help="hash algorithm to use (default: blake2b)")
 
     subparser_subset_sequences.add_argument("-e", "--excel_file", action="store", dest="excel_file", required=True,
                                             help="ProteinPilot results file")
@@ -186,12 +300,6 @@ def main():
         parser.print_help(sys.stderr)
         raise ValueError(msg)
 
-    lvl = "INFO"
-    if args.verbose:
-        lvl = "DEBUG"
-    logger = configure_logger(name="mptk_" + args.mode, log_file=args.log_file, level=lvl)
-    logger.setLevel(lvl)
-
     if args.license:
         print("mPies (metaProteomics in environmental scienes)")
         print("Copyright 2018 Johannes Werner (Leibniz-Institute for Baltic Sea Research)")
@@ -202,75 +310,15 @@ def main():
 
         sys.exit(0)
 
+    lvl = "INFO"
+    if args.verbose:
+        lvl = "DEBUG"
+    logger = configure_logger(name="mptk_" + args.mode, log_file=args.log_file, level=lvl)
+    logger.setLevel(lvl)
+
     logger.info("(metaproteomics toolkit) started")
 
-    if args.mode == "prepare_uniprot_files":
-        logger.info("parsing UniProt file")
-        general_functions.parse_uniprot_file(uniprot_file=args.uniprot_file, uniprot_table=args.uniprot_table,
-                                             go_annotation=args.go_annotation)
-
-    elif args.mode == "parse_singlem":
-        logger.info("parsing OTU table")
-        abspath_names_dmp = general_functions.get_names_dmp(names_dmp=args.names_dmp)
-        tax_dict = general_functions.create_tax_dict(abspath_names_dmp=abspath_names_dmp)
-        data_frame = parse_singlem.read_table(input_file=args.otu_table)
-        tax_list = parse_singlem.calculate_abundant_otus(df=data_frame, level=args.level, cutoff=args.cutoff)
-        validated_tax_list = parse_singlem.validate_taxon_names(taxon_names=tax_list, ncbi_tax_dict=tax_dict)
-        parse_singlem.write_taxon_list(validated_taxon_names=validated_tax_list,
-                                       taxon_file=args.taxon_file)
-
-    elif args.mode == "amplicon":
-        logger.info("started amplicon analysis")
-        abspath_names_dmp = general_functions.get_names_dmp(names_dmp=args.names_dmp)
-        tax_dict = general_functions.create_tax_dict(abspath_names_dmp=abspath_names_dmp)
-        taxids = use_amplicon.get_taxid(input_file=args.genus_list)
-        use_amplicon.get_protein_sequences(tax_list=taxids, output_file=args.proteome_file, ncbi_tax_dict=tax_dict,
-                                           reviewed=args.reviewed, add_taxonomy=args.taxonomy)
-
-    elif args.mode == "function_subset":
-        logger.info("creating functional subsets")
-        query_command = use_functional_subset.search_lists_to_query_url(args.toml_file)
-        use_amplicon.get_protein_sequences(tax_list=False, query=query_command, output_file=args.proteome_file, reviewed=args.reviewed, add_taxonomy=args.taxonomy)
-
-    elif args.mode == "hashing":
-        logger.info("hashing protein headers")
-        hash_headers.write_hashed_protein_header_fasta_file(input_file=args.proteome_file, output_file=args.hashed_file,
-                                                            tsv_file=args.tsv_file, hash_type=args.hash_type)
-
-    elif args.mode == "subset_sequences":
-        logger.info("subsetting sequences")
-        df = subset_sequences.parse_proteinpilot_file(excel_file=args.excel_file)
-        subset_sequences.subset_sequence_file(df=df, sequence_file=args.database_file,
-                                                              sequence_file_subset=args.database_subset)
-
-    elif args.mode == "protein_groups":
-        logger.info("use protein groups")
-        general_functions.map_protein_groups(diamond_file=args.diamond_file, excel_file=args.excel_file,
-                                             diamond_file_protein_groups=args.diamond_protein_groups)
-
-    elif args.mode == "taxonomy":
-        logger.info("parsing megan taxonomy file")
-        parse_taxonomy.parse_table(input_file=args.megan_results, output_file=args.taxonomy_table)
-
-    elif args.mode == "functions_cog":
-        logger.info("running COG analysis")
-        cog_df = general_functions.parse_diamond_output(diamond_file=args.diamond_file)
-        cog_df_merged = parse_functions_cog.join_tables(df=cog_df, cog_table=args.cog_table, cog_names=args.cog_names)
-        cog_df_grouped = parse_functions_cog.group_table(df=cog_df_merged, cog_functions=args.cog_functions)
-        parse_functions_cog.export_table(df=cog_df_grouped, output_file=args.export_table)
-
-    elif args.mode == "functions_uniprot":
-        logger.info("running Uniprot analysis")
-        uniprot_df = general_functions.parse_diamond_output(diamond_file=args.diamond_file)
-        uniprot_df_merged = parse_functions_uniprot.join_tables(uniprot_df, uniprot_table=args.uniprot_table,
-                                                                go_annotation=args.go_annotation)
-        uniprot_df_grouped = parse_functions_uniprot.group_table(uniprot_df_merged)
-        parse_functions_uniprot.export_table(df=uniprot_df_grouped, output_file=args.export_table)
-
-    elif args.mode == "export_tables":
-        logger.info("exporting tables")
-        general_functions.export_result_tables(excel_file=args.excel_file, annotated_table=args.annotated_table,
-                                               output_table=args.output_table)
+    DISPATCH[args.mode](args, logger)
 
     logger.info("Done and finished!")
 
@@ -3,30 +3,78 @@
 """
 Provide general functions necessary for multiple modules
 
-This module includes the functions `get_desired_ranks`, `get_names_dmp`, and `create_tax_dict` to download and access
-the NCBI taxonomy.
+This module includes the functions `get_ncbi_taxa`, `get_desired_ranks`, `get_names_dmp`, and `create_tax_dict` to
+download and access the NCBI taxonomy.
 """
 
+import csv
 import gzip
 import logging
+from functools import lru_cache
 import os
 import pandas as pd
+import pickle
 import re
+import shutil
 import tarfile
 import urllib.parse
 import urllib.request
-from ete3 import NCBITaxa
 
 logger = logging.getLogger("pies.general_functions")
-NCBI = NCBITaxa()
+_NCBI = None
+_UNIPROT_ID = re.compile(r"ID")
+_UNIPROT_GO = re.compile(r"DR\s+GO;")
+_UNIPROT_RECNAME = re.compile(r"DE\s+RecName:")
+RANKS = ("superkingdom", "phylum", "class", "order", "family", "genus")
+_DEFAULT_RANKS = dict.fromkeys(RANKS, -1)
 
 
+def get_ncbi_taxa():
+    """
+    Return the shared NCBITaxa instance.
+
+    The ete3 taxonomy database is only opened on first use, so run modes that do not need the NCBI taxonomy do not
+    pay for importing ete3 and opening its database.
+
+    Returns
+    -------
+      the NCBITaxa instance
+
+    """
+    global _NCBI
+    if _NCBI is None:
+        from ete3 import NCBITaxa
+        _NCBI = NCBITaxa()
+
+    return _NCBI
+
+
+def reset_ncbi_taxa():
+    """
+    Drop the shared NCBITaxa instance.
+
+    The SQLite connection of ete3 must not be used across `fork`, so worker processes call this function before
+    accessing the NCBI taxonomy. A new instance is created on next use by `get_ncbi_taxa`.
+
+    Returns
+    -------
+      None
+
+    """
+    global _NCBI
+    _NCBI = None
+
+    return None
+
+
+@lru_cache(maxsize=100000)
 def get_desired_ranks(taxid):
     """
     Get taxonomic lineage on taxid for desired ranks.
 
     The function get_desired_ranks uses a taxid as input and returns a dict of ranks (superkingdom,
-    phylum, class, order, family, genus, species) as keys and corresponding taxIDs as values.
+    phylum, class, order, family, genus, species) as keys and corresponding taxIDs as values. Results are cached per
+    taxid, so the returned dict is shared between calls and must not be modified.
 
     Parameters
     ----------
@@ -38,23 +86,21 @@ def get_desired_ranks(taxid):
 
     """
     if taxid == -1:
-        return {"superkingdom": -1, "phylum": -1, "class": -1, "order": -1, "family": -1,
-                "genus": -1}
-    lineage = NCBI.get_lineage(taxid)
-    lineage2ranks = NCBI.get_rank(lineage)
+        return dict(_DEFAULT_RANKS)
+    lineage = get_ncbi_taxa().get_lineage(taxid)
+    lineage2ranks = get_ncbi_taxa().get_rank(lineage)
     ranks2lineage = dict((rank, taxid) for (taxid, rank) in lineage2ranks.items())
-    for taxrank in ["superkingdom", "phylum", "class", "order", "family", "genus"]:
-        if taxrank not in ranks2lineage:
-            ranks2lineage[taxrank] = -1
 
-    return ranks2lineage
+    return {**_DEFAULT_RANKS, **ranks2lineage}
 
 
 def get_names_dmp(names_dmp=None):
     """
     Download names.dmp.
 
-    The function downloades the names.dmp file if not already existing or if the file size is zero.
+    The function downloades the names.dmp file if not already existing or if the file size is zero. The archive
+    taxdump.tar.gz is decompressed while downloading and only names.dmp is written to disk. names.dmp is first written
+    to a temporary file and only moved into place once it has been read completely.
 
     Parameter
     ---------
@@ -65,27 +111,31 @@ def get_names_dmp(names_dmp=None):
       absolute path of file names.dmp
 
     """
-    if names_dmp is not None:
-        if os.stat(names_dmp).st_size == 0:
-            os.remove(names_dmp)
-        else:
-            return os.path.abspath(names_dmp)
-    else:
+    if names_dmp is None:
         names_dmp = "names.dmp"
-        if os.path.isfile("names.dmp"):
-            if os.stat(names_dmp).st_size != 0:
-                return os.path.abspath(names_dmp)
-
-            else:
-                os.remove(names_dmp)
+    try:
+        if os.stat(names_dmp).st_size != 0:
+            return os.path.abspath(names_dmp)
+        os.remove(names_dmp)
+    except FileNotFoundError:
+        pass
 
     logger.info("Downloading taxdump.tar.gz ...")
-    urllib.request.urlretrieve("ftp://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz",
-                               filename="taxdump.tar.gz")
-    tar = tarfile.open("taxdump.tar.gz")
-    tar.extract("names.dmp")
-    tar.close()
-    os.remove("taxdump.tar.gz")
+    tmp_names_dmp = "names.dmp.%d.tmp" % os.getpid()
+    try:
+        with urllib.request.urlopen("ftp://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz") as response, \
+                tarfile.open(fileobj=response, mode="r|gz") as tar:
+            for member in tar:
+                if member.name == "names.dmp":
+                    with tar.extractfile(member) as member_open, open(tmp_names_dmp, "wb") as tmp_names_dmp_open:
+                        shutil.copyfileobj(member_open, tmp_names_dmp_open, 1 << 20)
+                    break
+            else:
+                raise ValueError("taxdump.tar.gz does not contain names.dmp")
+        os.replace(tmp_names_dmp, "names.dmp")
+    finally:
+        if os.path.exists(tmp_names_dmp):
+            os.remove(tmp_names_dmp)
 
     return os.path.abspath("names.dmp")
 
@@ -96,9 +146,9 @@ def create_tax_dict(abspath_names_dmp):
 
     The function uses names.dmp to create a tax dictionary to map taxIDs onto tax names.
 
-    Below, the first 10 lines of the current version of names.dmp are shown. The first column
-    (`curr_line[0]`) represents the taxID, the second column (`curr_line[1]`) the name and the
-    fourth column (`curr_line[3]`) if the name is a valid scientific name.
+    Below, the first 10 lines of the current version of names.dmp are shown. The first column represents the taxID,
+    the second column the name and the fourth column if the name is a valid scientific name. The file is read with the
+    C parser of pandas, splitting on `|` and stripping the surrounding tabs afterwards.
 
     ```
     $ head names.dmp
@@ -115,6 +165,10 @@ def create_tax_dict(abspath_names_dmp):
     2	|	not Bacteria Haeckel 1894	|		|	authority	|
     ```
 
+    The resulting dictionary is cached in `names.dmp.cache.pkl` next to names.dmp and reused as long as the
+    modification time and size of names.dmp do not change. The cache is written to a temporary file and moved into
+    place, so concurrent runs never read a partially written cache.
+
     Parameter
     ---------
       abspath_names_dmp: absolute path of of names.dmp
@@ -124,14 +178,35 @@ def create_tax_dict(abspath_names_dmp):
       ncbi_tax_dict: tax dictionary
 
     """
+    names_dmp_stat = os.stat(abspath_names_dmp)
+    cache_key = (names_dmp_stat.st_mtime_ns, names_dmp_stat.st_size)
+    cache_file = abspath_names_dmp + ".cache.pkl"
+    try:
+        with open(cache_file, "rb") as cache_file_open:
+            cached_key, ncbi_tax_dict = pickle.load(cache_file_open)
+        if cached_key == cache_key:
+            logger.info("using cached tax dictionary ...")
+            return ncbi_tax_dict
+    except (OSError, EOFError, TypeError, ValueError, pickle.UnpicklingError):
+        pass
+
     ncbi_tax_dict = {}
     ncbi_tax_dict[-1] = -1
     logger.info("creating tax dictionary ...")
-    with open(abspath_names_dmp) as names_dmp_open:
-        for line in names_dmp_open:
-            curr_line = re.split(r"\t*\|\t*", line.rstrip())
-            if curr_line[3] == "scientific name":
-                ncbi_tax_dict[int(curr_line[0])] = curr_line[1]
+    df = pd.read_csv(abspath_names_dmp, sep="|", header=None, usecols=[0, 1, 3], dtype=str, quoting=csv.QUOTE_NONE,
+                     na_filter=False, engine="c")
+    df = df[df[3].str.strip() == "scientific name"]
+    ncbi_tax_dict.update(zip(df[0].str.strip().astype(int).tolist(), df[1].str.strip().tolist()))
+
+    tmp_cache_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    try:
+        with open(tmp_cache_file, "wb") as cache_file_open:
+            pickle.dump((cache_key, ncbi_tax_dict), cache_file_open, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_cache_file, cache_file)
+    except OSError:
+        logger.warning("could not write tax dictionary cache " + cache_file)
+        if os.path.exists(tmp_cache_file):
+            os.remove(tmp_cache_file)
 
     return ncbi_tax_dict
 
@@ -154,15 +229,15 @@ def parse_uniprot_file(uniprot_file, uniprot_table, go_annotation=False):
     """
     with gzip.open(uniprot_file, "rt") as f, gzip.open(uniprot_table, "wb") as uniprot_table_open:
         for line in f:
-            if re.match(r"ID", line):
+            if _UNIPROT_ID.match(line):
                 id_field = line.split()[1]
             if go_annotation:
-                if re.match(r"DR\s+GO;", line):
+                if _UNIPROT_GO.match(line):
                     go_field = line.split(maxsplit=1)[1:]
                     go_field = go_field[0].split("; ")[1:3]
                     uniprot_table_open.write(bytes(id_field + "\t" + go_field[0] + "\t" + go_field[1] + "\n", encoding="utf-8"))
             else:
-                if re.match(r"DE\s+RecName:", line):
+                if _UNIPROT_RECNAME.match(line):
                     proteinname = line.split(maxsplit=1)[1:]
                     proteinname_field = proteinname[0].split("=")[1].rstrip()
                     uniprot_table_open.write(bytes(id_field + "\t" + proteinname_field + "\n", encoding="utf-8"))
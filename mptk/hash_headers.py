@@ -4,13 +4,38 @@
 This module hashes the headers of the proteome file.
 """
 
+import functools
 import hashlib
 import logging
+import os
 
 logger = logging.getLogger("mptk.hashing")
+_FLUSH_SIZE = 1 << 20
+_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
 
 
-def write_hashed_protein_header_fasta_file(input_file, output_file, tsv_file, hash_type):
+def _write_all(fd, buffer):
+    """
+    Write the complete buffer to a file descriptor.
+
+    Parameters
+    ----------
+      fd: file descriptor opened for writing
+      buffer: bytes-like object to write
+
+    Returns
+    -------
+      None
+    """
+    written = 0
+    with memoryview(buffer) as view:
+        while written < len(view):
+            written += os.write(fd, view[written:])
+
+    return
+
+
+def write_hashed_protein_header_fasta_file(input_file, output_file, tsv_file, hash_type="blake2b"):
     """
     Hash headers of proteome file.
 
@@ -19,33 +44,55 @@ def write_hashed_protein_header_fasta_file(input_file, output_file, tsv_file, ha
     tools (e.g. ProteinPilot) are keeping not only the sequence but also the headers in-memory. Therefore, shorter
     fasta headers allow processing more reference protein sequences in one run.
 
+    Each header is hashed independently. For blake2b, a digest size of 16 bytes is used, which results in hashed
+    headers of the same length as md5.
+
     Additionally, a tsv file with two column is created that maps the hashed header
-    to the original headers. The function returns None.
+    to the original headers. The input is read in binary mode and sequence lines are copied without
+    decoding; both output files are written with os.write in chunks of about 1 MiB. The function returns None.
 
     Parameters
     ----------
       input_file: input proteome file
       output_file: output proteome file with hashed headers
       tsv_file: output tsv file
-      hash_type: hash algorithm to use
+      hash_type: hash algorithm to use (default: blake2b)
 
     Returns
     -------
       None
     """
-    h = hashlib.new(hash_type)
-
-    with open(input_file) as input_file_open, open(output_file, "w") as output_file_open, open(tsv_file, "w") as tsv_file_open:
-        for line in input_file_open:
-            if line.startswith(">"):
-                header_substring = line.rstrip()[1:]
-                h.update(header_substring.encode("utf-8")) # .hexdigest()
-                hashed_header = h.hexdigest()
-                quoted_hashed_header = '\"' + hashed_header + '\"'
-                output_file_open.write(">" + hashed_header + "\n")
-                tsv_file_open.write(quoted_hashed_header + "\t" + header_substring + "\n")
-            else:
-                output_file_open.write(line)
+    hash_function = getattr(hashlib, hash_type)
+    if hash_type == "blake2b":
+        hash_function = functools.partial(hash_function, digest_size=16)
+
+    output_buffer = bytearray()
+    tsv_buffer = bytearray()
+
+    output_fd = os.open(output_file, _OPEN_FLAGS, 0o666)
+    tsv_fd = os.open(tsv_file, _OPEN_FLAGS, 0o666)
+    try:
+        with open(input_file, "rb") as input_file_open:
+            for line in input_file_open:
+                if line.startswith(b">"):
+                    header_substring = line[1:].rstrip()
+                    hashed_header = hash_function(header_substring).hexdigest().encode("ascii")
+                    output_buffer += b">%b\n" % hashed_header
+                    tsv_buffer += b'"%b"\t%b\n' % (hashed_header, header_substring)
+                    if len(tsv_buffer) > _FLUSH_SIZE:
+                        _write_all(tsv_fd, tsv_buffer)
+                        tsv_buffer.clear()
+                else:
+                    output_buffer += line
+                if len(output_buffer) > _FLUSH_SIZE:
+                    _write_all(output_fd, output_buffer)
+                    output_buffer.clear()
+
+        _write_all(output_fd, output_buffer)
+        _write_all(tsv_fd, tsv_buffer)
+    finally:
+        os.close(output_fd)
+        os.close(tsv_fd)
 
     return
 
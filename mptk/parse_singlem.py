@@ -12,8 +12,10 @@ import logging
 import numpy as np
 import pandas as pd
 import re
+from mptk import general_functions
 
 logger = logging.getLogger("pies.parse_singlem")
+_GENUS_RE = re.compile(r"^g__(.+)")
 
 
 def read_table(input_file):
@@ -21,7 +23,7 @@ def read_table(input_file):
     Read the OTU table and return a pandas data frame.
 
     The function `read_table` reads the OTU table produced by SingleM. Unnecessary columns are removed and the
-    taxonomy column is separated. The function returns the resulting data frame.
+    taxonomy column is separated into one categorical column per rank. The function returns the resulting data frame.
 
     Parameters
     ----------
@@ -32,17 +34,12 @@ def read_table(input_file):
       df: OTU table as pandas data frame object
 
     """
-    df = pd.read_table(input_file)
-    df = df[["sample", "num_hits", "taxonomy"]]
-    df = pd.concat([df[["sample", "num_hits"]],
-                   df["taxonomy"].str.split('; ', expand=True).add_prefix("taxonomy_").fillna(np.nan)], axis=1)
-    df = df.drop("taxonomy_0", axis=1)
-    df = df.rename(columns={"taxonomy_1": "superkingdom",
-                            "taxonomy_2": "phylum",
-                            "taxonomy_3": "class",
-                            "taxonomy_4": "order",
-                            "taxonomy_5": "family",
-                            "taxonomy_6": "genus"})
+    df = pd.read_table(input_file, usecols=["sample", "num_hits", "taxonomy"], dtype={"num_hits": np.int32})
+    taxonomy = df["taxonomy"].str.split("; ", n=7, expand=True)
+    df = df.drop("taxonomy", axis=1)
+    for column, rank in enumerate(general_functions.RANKS, start=1):
+        df[rank] = taxonomy[column] if column in taxonomy else np.nan
+        df[rank] = df[rank].astype("category")
 
     return df
 
@@ -66,9 +63,8 @@ def calculate_abundant_otus(df, level="genus", cutoff=5):
       taxon_names: list of unvalidated taxon names
 
     """
-    df_subset = df.groupby([level])["num_hits"].sum().reset_index()
-    df_subset = df_subset[df_subset["num_hits"] >= int(cutoff)][level]
-    taxon_names = list(df_subset)
+    hits = df.groupby(level, sort=False, observed=True)["num_hits"].sum()
+    taxon_names = hits.index[hits.values >= int(cutoff)].tolist()
 
     return taxon_names
 
@@ -79,7 +75,8 @@ def validate_taxon_names(taxon_names, ncbi_tax_dict):
 
     The function `validate_taxon_names` uses the list taxon names as input and validates them against the list of
     allowed NCBI taxon names. The function returns a list of validated NCBI taxon names (that is smaller or equal than
-    the input list.
+    the input list) in the order of the input list. Only genus names (prefix g__) can be validated, other names are
+    skipped with a warning.
 
     Parameters
     ----------
@@ -91,12 +88,20 @@ def validate_taxon_names(taxon_names, ncbi_tax_dict):
       validated_taxon_names: list of validated taxon names
 
     """
-    present_taxon_names = []
+    present_taxon_names = {}
+    skipped_taxon_names = []
     for item in taxon_names:
-        rx_match = re.search(r"^g__(.+)", item)
-        present_taxon_names.append(rx_match.group(1).split("_")[0])
+        rx_match = _GENUS_RE.match(item)
+        if rx_match:
+            present_taxon_names[rx_match.group(1).split("_", 1)[0]] = None
+        else:
+            skipped_taxon_names.append(item)
 
-    validated_taxon_names = list(set(present_taxon_names).intersection(ncbi_tax_dict.values()))
+    if skipped_taxon_names:
+        logger.warning("skipping taxon names without genus prefix (g__): " + ", ".join(skipped_taxon_names))
+
+    valid_taxon_names = set(present_taxon_names).intersection(ncbi_tax_dict.values())
+    validated_taxon_names = [name for name in present_taxon_names if name in valid_taxon_names]
 
     return validated_taxon_names
 
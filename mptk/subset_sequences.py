@@ -18,7 +18,8 @@ def parse_proteinpilot_file(excel_file):
     Parses the ProteinPilot result Excel file.
 
     The function parse_proteinpilot_file extracts the columns N, Accession, and Peptides(95%) from the UniProt results
-    file.
+    file. The positions of these columns are looked up in the header, so that only they are converted into the data
+    frame.
 
     Parameters
     ----------
@@ -29,9 +30,12 @@ def parse_proteinpilot_file(excel_file):
       df: a data frame with the kept columns
 
     """
-    df = pd.read_excel(excel_file)
-    df = df[["N", "Accession", "Peptides(95%)"]]
-    df["Accession"] = df["Accession"].str.split("|", expand=False).str[0]
+    columns = ["N", "Accession", "Peptides(95%)"]
+    excel = pd.ExcelFile(excel_file)
+    header = excel.parse(nrows=0).columns
+    df = excel.parse(usecols=sorted(header.get_loc(column) for column in columns))
+    df = df[columns]
+    df["Accession"] = df["Accession"].str.split("|", n=1, expand=True)[0]
 
     return df
 
@@ -40,34 +44,31 @@ def subset_sequence_file(df, sequence_file, sequence_file_subset):
     """
     Creates a subset of the sequence file.
 
-    Based on the identified protein accessions, a subset of the protein fasta file is generated.
+    Based on the identified protein accessions, a subset of the protein fasta file is generated. The sequence file is
+    processed in a single pass, so multi-line sequences are kept as they are.
 
     Parameters
     ----------
       df: a data frame with the kept columns
       sequence_file: the sequence file generated by mPies part I
+      sequence_file_subset: the subsetted sequence file
 
     Returns
     -------
       None
 
     """
-    sequence_dict = {}
-
-    fasta_headers = df["Accession"].tolist()
+    fasta_headers = set(df["Accession"].unique())
+    keep = False
     with open(sequence_file) as sequence_file_open, open(sequence_file_subset, "w") as sequence_file_subset_open:
         for line in sequence_file_open:
             if line.startswith(">"):
-                header = line.rstrip()
-            else:
-                seq = line.rstrip()
-                sequence_dict[header] = seq
-
-        for key in sequence_dict:
-            id = key[1:].split()[0]
-            if id in fasta_headers:
-                sequence_file_subset_open.write(key + "\n")
-                sequence_file_subset_open.write(sequence_dict[key] + "\n")
+                id = line[1:].split(None, 1)[0]
+                keep = id in fasta_headers
+                if keep:
+                    sequence_file_subset_open.write(line)
+            elif keep:
+                sequence_file_subset_open.write(line)
 
     return
 
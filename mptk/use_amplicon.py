@@ -8,15 +8,24 @@ the respective genera. The taxonomic lineage will be added to the protein header
 """
 
 import logging
+import multiprocessing
 import os
 import re
-import urllib.parse
-import urllib.request
-from ete3 import NCBITaxa
+import requests
+import shutil
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 from mptk import general_functions
 
 logger = logging.getLogger("pies.use_amplicon")
-NCBI = NCBITaxa()
+_OS_RE = re.compile(rb"OS=(\w+)\s", re.ASCII)
+_BUFFER_SIZE = 1 << 22
+_FLUSH_SIZE = 1 << 20
+_PARALLEL_MIN_SIZE = 1 << 26
+_WORKER_TAX_DICT = None
+_TAXA_PER_QUERY = 50
+_DOWNLOAD_WORKERS = 8
+_DOWNLOAD_TIMEOUT = (30, 300)
 
 
 def get_taxid(input_file):
@@ -24,7 +33,7 @@ def get_taxid(input_file):
     Return a list of tax IDs based on tax names.
 
     Each line of the input_file has a tax name on each line. The function `get_taxid` returns a
-    list with tax IDs with the same length.
+    list with tax IDs with the same length. The tax IDs keep the order of the names in the input file.
 
     Parameters
     ----------
@@ -35,68 +44,269 @@ def get_taxid(input_file):
       tax_list: unique list with tax IDs
 
     """
-    names_list = []
-    tax_list = []
-
     with open(input_file) as input_file_open:
-        for line in input_file_open:
-            names_list.append(line.rstrip())
-
-    tax_dict = NCBI.get_name_translator(names_list)
-    for key in tax_dict:
-        tax_list.append(tax_dict[key][0])
+        names = dict.fromkeys(line.rstrip() for line in input_file_open if line.strip())
 
-    tax_list = list(set(tax_list))
+    tax_dict = general_functions.get_ncbi_taxa().get_name_translator(list(names))
+    tax_list = list(dict.fromkeys(tax_dict[name][0] for name in names if name in tax_dict))
 
     return tax_list
 
 
-def add_taxonomy_to_fasta(fasta_file, ncbi_tax_dict):
+def _find_record_boundaries(fasta_file, parts):
+    """
+    Split a fasta file into byte ranges at record boundaries.
+
+    The file is divided into `parts` ranges of roughly equal size. Each range starts at a header line, so that no record
+    is split between two ranges.
+
+    Parameters
+    ----------
+      fasta_file: input fasta file
+      parts: number of ranges
+
+    Returns
+    -------
+      boundaries: sorted list of byte offsets (including 0 and the file size)
+
+    """
+    file_size = os.path.getsize(fasta_file)
+    boundaries = {0, file_size}
+
+    with open(fasta_file, "rb") as fasta_file_open:
+        for part in range(1, parts):
+            fasta_file_open.seek(part * file_size // parts)
+            fasta_file_open.readline()
+            while True:
+                line = fasta_file_open.readline()
+                if not line:
+                    break
+                if line.startswith(b">"):
+                    boundaries.add(fasta_file_open.tell() - len(line))
+                    break
+
+    return sorted(boundaries)
+
+
+def _add_taxonomy_to_range(fasta_file, start, end, output_filename, ncbi_tax_dict):
+    """
+    Add taxonomy to the headers of one byte range of the fasta file.
+
+    Parameters
+    ----------
+      fasta_file: input fasta file
+      start: byte offset of the first record
+      end: byte offset after the last record
+      output_filename: output file for the annotated range
+      ncbi_tax_dict: taxonomy dictionary generated by general_functions.create_tax_dict()
+
+    Returns
+    -------
+      None
+
+    """
+    output_buffer = bytearray()
+    header_extensions = {}
+    position = start
+
+    with open(fasta_file, "rb") as fasta_file_open, \
+            open(output_filename, "wb", buffering=_BUFFER_SIZE) as output_file_open:
+        fasta_file_open.seek(start)
+        for line in fasta_file_open:
+            if position >= end:
+                break
+            position += len(line)
+            if line.startswith(b">"):
+                rx_match = _OS_RE.search(line)
+                if rx_match:
+                    taxid = rx_match.group(1)
+                    header_extension = header_extensions.get(taxid)
+                    if header_extension is None:
+                        ranks = general_functions.get_desired_ranks(taxid.decode("ascii"))
+                        res = [str(ncbi_tax_dict[ranks[rank]]) for rank in general_functions.RANKS]
+                        header_extension = ", ".join(res).encode("utf-8")
+                        header_extensions[taxid] = header_extension
+                else:
+                    header_extension = b"not_found"
+                output_buffer += line.rstrip() + b" TAX=" + header_extension + b"\n"
+            else:
+                output_buffer += line
+            if len(output_buffer) > _FLUSH_SIZE:
+                output_file_open.write(output_buffer)
+                output_buffer.clear()
+
+        output_file_open.write(output_buffer)
+
+    return None
+
+
+def _add_taxonomy_to_part(part):
+    """
+    Annotate one part of the fasta file in a worker process.
+
+    The taxonomy dictionary is inherited from the parent process (see `add_taxonomy_to_fasta`).
+
+    Parameters
+    ----------
+      part: tuple of fasta file, start offset, end offset and output file of the part
+
+    Returns
+    -------
+      None
+
+    """
+    fasta_file, start, end, part_filename = part
+    _add_taxonomy_to_range(fasta_file, start, end, part_filename, _WORKER_TAX_DICT)
+
+    return None
+
+
+def add_taxonomy_to_fasta(fasta_file, ncbi_tax_dict, processes=1):
     """
     Add taxonomy to headers.
 
     The function adds the complete taxonomic lineage to the fasta header (superkingdom, phylum,
-    class, order, family, genus).
+    class, order, family, genus). The formatted lineage is computed once per organism.
+
+    Fasta files larger than 64 MiB are split at record boundaries and annotated in parallel by forked worker processes
+    (one part per process), which inherit the taxonomy dictionary. The annotated parts are concatenated afterwards.
 
     Parameter
     ---------
       fasta_file: input fasta file
       ncbi_tax_dict: taxonomy dictionary generated by general_functions.create_tax_dict()
+      processes: number of worker processes (default: 1)
 
     Returns
     -------
       None
 
     """
+    global _WORKER_TAX_DICT
+
     output_filename = os.path.splitext(fasta_file)[0] + "_tax.fasta"
-    with open(fasta_file) as fasta_file_open, open(output_filename, "w") as output_file_open:
-        for line in fasta_file_open:
-            if line.startswith(">"):
-                rx_match = re.search(r"OS=(\w+)\s", line)
-                if rx_match:
-                    taxid = rx_match.group(1)
+    processes = processes or 1
+
+    if processes == 1 or os.path.getsize(fasta_file) < _PARALLEL_MIN_SIZE:
+        boundaries = [0, os.path.getsize(fasta_file)]
+    else:
+        boundaries = _find_record_boundaries(fasta_file, processes)
+
+    if len(boundaries) <= 2:
+        _add_taxonomy_to_range(fasta_file, boundaries[0], boundaries[-1], output_filename, ncbi_tax_dict)
+        return None
+
+    parts = [(fasta_file, start, end, "%s.part%d" % (output_filename, index))
+             for index, (start, end) in enumerate(zip(boundaries[:-1], boundaries[1:]))]
+    # open (and if necessary download) the taxonomy database once before the workers reopen it
+    general_functions.get_ncbi_taxa()
+    _WORKER_TAX_DICT = ncbi_tax_dict
+    try:
+        with multiprocessing.get_context("fork").Pool(len(parts), initializer=general_functions.reset_ncbi_taxa) \
+                as pool:
+            pool.map(_add_taxonomy_to_part, parts)
+
+        with open(output_filename, "wb") as output_file_open:
+            for _, _, _, part_filename in parts:
+                with open(part_filename, "rb") as part_file_open:
+                    shutil.copyfileobj(part_file_open, output_file_open, _FLUSH_SIZE)
+    finally:
+        _WORKER_TAX_DICT = None
+        for _, _, _, part_filename in parts:
+            if os.path.exists(part_filename):
+                os.remove(part_filename)
 
-                    res = []
-                    for rank in ["superkingdom", "phylum", "class", "order", "family", "genus"]:
-                        res.append(str(ncbi_tax_dict[get_desired_ranks(taxid)[rank]]))
+    return None
 
-                    header_extension = ", ".join(res)
-                else:
-                    header_extension = "not_found"
-                output_file_open.write(line.rstrip() + " TAX=" + header_extension + "\n")
-            else:
-                output_file_open.write(line)
+
+def _download_protein_sequences(query, filename):
+    """
+    Download the protein sequences matching a UniProt query.
+
+    The query is sent as POST request and the response is written to the file in chunks while it is downloaded. An
+    incomplete download raises `urllib.error.ContentTooShortError` and the file is removed.
+
+    Parameters
+    ----------
+      query: UniProt query
+      filename: output file for the downloaded protein sequences
+
+    Returns
+    -------
+      None
+
+    """
+    url = 'https://www.uniprot.org/uniprot/'
+
+    params = {'query': query, 'force': 'yes', 'format': 'fasta'}
+    with requests.post(url, data=params, stream=True, timeout=_DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        try:
+            with open(filename, "wb") as filename_open:
+                for chunk in response.iter_content(chunk_size=_FLUSH_SIZE):
+                    filename_open.write(chunk)
+
+            # the raw byte count matches Content-Length also for compressed responses
+            content_length = response.headers.get("Content-Length")
+            if content_length is not None and response.raw.tell() != int(content_length):
+                raise urllib.error.ContentTooShortError(
+                    "retrieval incomplete: got only %d out of %s bytes" % (response.raw.tell(), content_length), None)
+        except BaseException:
+            if os.path.exists(filename):
+                os.remove(filename)
+            raise
+
+    return None
+
+
+def _concatenate_unique_records(part_filenames, filename):
+    """
+    Concatenate fasta files and keep only the first record of each accession.
+
+    Shards of a sharded UniProt query can overlap if one taxon is nested inside another one, so the same protein can
+    be part of several shards. The accession is the first word of the header.
+
+    Parameters
+    ----------
+      part_filenames: list of fasta files to concatenate
+      filename: output fasta file
+
+    Returns
+    -------
+      None
+
+    """
+    output_buffer = bytearray()
+    accessions = set()
+    keep = False
+
+    with open(filename, "wb", buffering=_BUFFER_SIZE) as filename_open:
+        for part_filename in part_filenames:
+            with open(part_filename, "rb") as part_file_open:
+                for line in part_file_open:
+                    if line.startswith(b">"):
+                        accession = (line[1:].split(None, 1) or [line])[0]
+                        keep = accession not in accessions
+                        accessions.add(accession)
+                    if keep:
+                        output_buffer += line
+                    if len(output_buffer) > _FLUSH_SIZE:
+                        filename_open.write(output_buffer)
+                        output_buffer.clear()
+
+        filename_open.write(output_buffer)
 
     return None
 
 
 def get_protein_sequences(tax_list, output_file, ncbi_tax_dict, query=None, reviewed=False,
-                          add_taxonomy=True):
+                          add_taxonomy=True, processes=1):
     """
     Fetch the proteomes for all tax IDs.
 
     The function takes a list of tax IDs and downloads the protein sequences for the descending
-    organisms.
+    organisms. Large tax ID lists are split into queries of 50 tax IDs, which are downloaded in parallel and
+    concatenated in order. Proteins returned by more than one query are only written once.
 
     Parameters
     ----------
@@ -104,6 +314,8 @@ def get_protein_sequences(tax_list, output_file, ncbi_tax_dict, query=None, revi
       output_file: output file for the downloaded protein sequences
       query: query can be passed from the use_functional_subset module (if None, download entire proteome of taxa of interest)
       reviewed: use TrEMBL (False) or SwissProt (True)
+      add_taxonomy: add the taxonomic lineage to the fasta headers
+      processes: number of processes used to add the taxonomy (default: 1)
 
     Returns
     -------
@@ -114,26 +326,40 @@ def get_protein_sequences(tax_list, output_file, ncbi_tax_dict, query=None, revi
     filename = output_file
 
     rev = " reviewed:%s" % reviewed if reviewed else ''
-    if not query:
-        taxon_queries = ['taxonomy:"%s"' % tid for tid in tax_list]
-        taxon_query = ' OR '.join(taxon_queries)
-        query = "%s%s" % (taxon_query, rev)
+    if query:
+        queries = [query]
+    else:
+        tax_list = list(tax_list or [])
+        queries = []
+        for start in range(0, max(len(tax_list), 1), _TAXA_PER_QUERY):
+            taxon_queries = ['taxonomy:"%s"' % tid for tid in tax_list[start:start + _TAXA_PER_QUERY]]
+            taxon_query = ' OR '.join(taxon_queries)
+            queries.append("%s%s" % (taxon_query, rev))
 
-    url = 'https://www.uniprot.org/uniprot/'
-
-    params = {'query': query, 'force': 'yes', 'format': 'fasta'}
-    data = urllib.parse.urlencode(params).encode("utf-8")
     if not tax_list:
         logger.info("Taxid: " + str(tax_list))
-    msg = urllib.request.urlretrieve(url=url, filename=filename, data=data)[1]
-    headers = {j[0]: j[1].strip() for j in [i.split(':', 1)
-                                                for i in str(msg).strip().splitlines()]}
 
-    if 'Content-Length' in headers and headers['Content-Length'] == 0:
+    if len(queries) == 1:
+        _download_protein_sequences(queries[0], filename)
+    else:
+        part_filenames = ["%s.part%d" % (filename, index) for index in range(len(queries))]
+        try:
+            with ThreadPoolExecutor(max_workers=min(_DOWNLOAD_WORKERS, len(queries))) as executor:
+                list(executor.map(_download_protein_sequences, queries, part_filenames))
+
+            _concatenate_unique_records(part_filenames, filename)
+        finally:
+            for part_filename in part_filenames:
+                if os.path.exists(part_filename):
+                    os.remove(part_filename)
+
+    if os.stat(filename).st_size == 0:
+        logger.warning("no protein sequences found")
         os.remove(filename)
+        return
 
     if add_taxonomy:
-        add_taxonomy_to_fasta(filename, ncbi_tax_dict)
+        add_taxonomy_to_fasta(filename, ncbi_tax_dict, processes=processes)
 
     return
 